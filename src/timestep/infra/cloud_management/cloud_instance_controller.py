@@ -1,5 +1,6 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
 from libcloud.compute.base import (
@@ -49,6 +50,11 @@ class CloudInstanceController:
 
         # Initialize drivers for each provider
         for provider, creds in credentials.items():
+            # Skip providers without credentials so their drivers are never loaded
+            if not any(creds.values()):
+                self.logger.info(f"Skipping {provider} cloud driver: no credentials")
+                continue
+
             try:
                 driver_class = get_driver(provider_map.get(provider))
 
@@ -124,6 +130,10 @@ class CloudInstanceController:
         """
         matching_images = []
 
+        # Normalize the filters once so each image is a set lookup
+        image_ids = frozenset(allowed_image_ids or ())
+        image_names = frozenset(name.lower() for name in allowed_image_names or ())
+
         try:
             images = driver.list_images()
 
@@ -132,12 +142,11 @@ class CloudInstanceController:
 
             for image in images:
                 # Check if image matches any allowed ID
-                id_match = (not allowed_image_ids) or (image.id in allowed_image_ids)
+                id_match = (not image_ids) or (image.id in image_ids)
 
                 # Check if image matches any name pattern
-                name_match = (not allowed_image_names) or any(
-                    name.lower() == str(image.name).lower()
-                    for name in allowed_image_names
+                name_match = (not image_names) or (
+                    str(image.name).lower() in image_names
                 )
 
                 if id_match or name_match:
@@ -171,6 +180,15 @@ class CloudInstanceController:
         """
         matching_locations = []
 
+        # Normalize the filters once so each location is a set lookup
+        location_countries = frozenset(
+            country.lower() for country in allowed_location_countries or ()
+        )
+        location_ids = frozenset(allowed_location_ids or ())
+        location_names = frozenset(
+            name.lower() for name in allowed_location_names or ()
+        )
+
         try:
             locations = driver.list_locations()
 
@@ -179,19 +197,15 @@ class CloudInstanceController:
 
             for location in locations:
                 # Check if image matches any allowed ID
-                country_match = (not allowed_location_countries) or any(
-                    country.lower() == str(location.country).lower()
-                    for country in allowed_location_countries
+                country_match = (not location_countries) or (
+                    str(location.country).lower() in location_countries
                 )
 
-                id_match = (not allowed_location_ids) or (
-                    location.id in allowed_location_ids
-                )
+                id_match = (not location_ids) or (location.id in location_ids)
 
                 # Check if image matches any name pattern
-                name_match = (not allowed_location_names) or any(
-                    name.lower() == str(location.name).lower()
-                    for name in allowed_location_names
+                name_match = (not location_names) or (
+                    str(location.name).lower() in location_names
                 )
 
                 if country_match or id_match or name_match:
@@ -221,35 +235,60 @@ class CloudInstanceController:
         """
         available_instances = []
 
-        for provider_name, driver in self.providers.items():
-            try:
-                # Fetch available nodes matching specifications
-                sizes = driver.list_sizes()
-
-                for size in sizes:
-                    if (
-                        (
-                            specs["min_bandwidth"] is None
-                            or size.bandwidth >= specs["min_bandwidth"]
-                        )
-                        and (
-                            specs["min_disk"] is None or size.disk >= specs["min_disk"]
-                        )
-                        and size.price > 0
-                        and (specs["min_ram"] is None or size.ram >= specs["min_ram"])
-                    ):
-                        available_instances.append(
-                            size,
-                        )
+        # Each provider lookup is a network round-trip, so query them concurrently
+        with ThreadPoolExecutor(max_workers=max(len(self.providers), 1)) as executor:
+            provider_matches = executor.map(
+                self._find_matching_sizes_for_provider,
+                self.providers.keys(),
+                self.providers.values(),
+                [specs] * len(self.providers),
+            )
 
-            except Exception as e:
-                self.logger.warning(
-                    f"Error fetching instances for {provider_name}: {e}"
-                )
+            for sizes in provider_matches:
+                available_instances.extend(sizes)
 
         # Sort instances by hourly cost
         return sorted(available_instances, key=lambda x: int(x.price))[0:limit]
 
+    def _find_matching_sizes_for_provider(
+        self, provider_name: str, driver: NodeDriver, specs: Dict
+    ) -> List[NodeSize]:
+        """
+        Retrieve the instance sizes of a single provider matching specifications.
+
+        Args:
+            provider_name (str): Name of the provider
+            driver (NodeDriver): Cloud provider driver
+            specs (Dict): Desired instance specifications
+
+        Returns:
+            List[NodeSize]: List of matching instance sizes
+        """
+        matching_sizes = []
+        min_bandwidth = specs["min_bandwidth"]
+        min_disk = specs["min_disk"]
+        min_ram = specs["min_ram"]
+
+        try:
+            # Fetch available nodes matching specifications
+            sizes = driver.list_sizes()
+
+            for size in sizes:
+                if (
+                    (min_bandwidth is None or size.bandwidth >= min_bandwidth)
+                    and (min_disk is None or size.disk >= min_disk)
+                    and size.price > 0
+                    and (min_ram is None or size.ram >= min_ram)
+                ):
+                    matching_sizes.append(
+                        size,
+                    )
+
+        except Exception as e:
+            self.logger.warning(f"Error fetching instances for {provider_name}: {e}")
+
+        return matching_sizes
+
     def get_instance_by_name(self, driver: NodeDriver, name: str) -> Optional[Node]:
         """
         Retrieve a cloud instance by name.
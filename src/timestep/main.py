@@ -3,19 +3,13 @@ import logging
 import os
 import subprocess
 import time
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import typer
 from click import Choice
-from libcloud.compute.base import Node
 
-from timestep.infra.cloud_management.cloud_instance_controller import (
-    CloudInstanceController,
-)
-from timestep.infra.cluster_management.k3s_cluster_controller import (
-    K3sClusterController,
-)
-from timestep.utils import ssh_connect
+if TYPE_CHECKING:
+    from libcloud.compute.base import Node
 
 # https://cloud-images.ubuntu.com/locator/
 DEFAULT_ALLOWED_IMAGES_IDS = [
@@ -148,6 +142,15 @@ def up(
     """
     Start up the Timestep AI platform.
     """
+    # Imported here so that `timestep --help` and other commands don't pay for
+    # loading libcloud and paramiko.
+    from timestep.infra.cloud_management.cloud_instance_controller import (
+        CloudInstanceController,
+    )
+    from timestep.infra.cluster_management.k3s_cluster_controller import (
+        K3sClusterController,
+    )
+    from timestep.utils import ssh_connect
 
     if clean:
         typer.echo("\nCleaning up...")
@@ -292,7 +295,7 @@ def up(
         )
         print(f"Created instance: {node}")
 
-        nodes_to_ip_addresses: List[Tuple[Node, List[str]]] = (
+        nodes_to_ip_addresses: List[Tuple["Node", List[str]]] = (
             selected_driver.wait_until_running([node])
         )
 
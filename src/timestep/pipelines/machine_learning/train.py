@@ -1,14 +1,21 @@
 import argparse
+import functools
 import json
 import os
 from pprint import pprint
 from typing import Dict, Union
 
 import mlflow
-import PIL
 import torch
 from datasets import interleave_datasets, load_dataset
 from datasets.features import Features, Image, Sequence, Value
+
+# Private helpers used by apply_chat_template; they only exist at the transformers
+# commit pinned in requirements.txt, so update these together with that pin
+from transformers.utils.chat_template_utils import (
+    _compile_jinja_template,
+    _render_with_assistant_indices,
+)
 from trl import SFTConfig, SFTTrainer
 from unsloth import FastVisionModel, is_bfloat16_supported
 
@@ -16,6 +23,18 @@ MLFLOW_TRACKING_URI = os.getenv("MLFLOW_TRACKING_URI")
 
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
+# unsloth sets its own PYTORCH_CUDA_ALLOC_CONF and initializes CUDA on import, so
+# the variable above comes too late; apply these allocator options at runtime
+if torch.cuda.is_available():
+    torch.cuda.memory._set_allocator_settings(
+        "max_split_size_mb:128,garbage_collection_threshold:0.9"
+    )
+
+# TF32 only exists on Ampere and newer GPUs; elsewhere these are no-ops
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True  # Image tiles have a fixed size
+
 mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
 
 mlflow.autolog(
@@ -25,20 +44,33 @@ mlflow.autolog(
     exclusive=False,
     extra_tags=None,
     # log_dataset=True,
-    log_input_examples=True,
-    log_model_signatures=True,
-    log_models=True,
+    log_input_examples=False,
+    log_model_signatures=False,
+    log_models=False,  # The LoRA adapter is logged once after training instead
     # log_trace=True,
-    silent=False,
+    silent=True,
 )
 
+debug = os.getenv("TIMESTEP_DEBUG", "0") == "1"  # Set to 1 to run sanity checks
 dtype = (
     None  # None for auto detection. Float16 for Tesla T4, V100, Bfloat16 for Ampere+
 )
 load_in_4bit = True  # Use 4bit quantization to reduce memory usage. Can be False.
+map_batch_size = 256  # Number of rows each dataset transform handles per call
 max_seq_length = 2048  # Supports RoPE Scaling interally, so choose any!
 # max_seq_length = 4096 # Choose any! We auto support RoPE Scaling internally!
-verbose = True
+# Fused AdamW keeps full-precision optimizer states; only use it on cards with
+# room to spare and keep the 8-bit states on small ones (e.g. a 4 GB GTX 1050 Ti)
+optim = (
+    "adamw_torch_fused"
+    if torch.cuda.is_available()
+    and torch.cuda.get_device_properties(0).total_memory >= 8 * 1024**3
+    else "adamw_8bit"
+)
+shuffle_buffer_size = 1_000  # Raw, still-encoded rows each stream shuffles over
+# Set to 1 to decode and compare every assistant mask in collate_fn
+validate_collate = os.getenv("TIMESTEP_VALIDATE_COLLATE", "0") == "1"
+verbose = os.getenv("TIMESTEP_VERBOSE", "0") == "1"  # Set to 1 to print batches
 
 
 def create_conversation_features():
@@ -111,14 +143,11 @@ features = create_conversation_features()
 def load_and_transform_chat_threads(features):
     chat_threads_train_dataset = load_dataset(
         "mjschock/chat_threads", split="train", streaming=True
-    )
+    ).shuffle(buffer_size=shuffle_buffer_size, seed=42)
 
-    def transform_chat_threads(
-        sample,
-        indices,
-    ):
-        messages = json.loads(sample["messages"])
-        tools = json.loads(sample["tools"])
+    def transform_chat_threads(batch):
+        messages = [json.loads(messages) for messages in batch["messages"]]
+        tools = [json.loads(tools) for tools in batch["tools"]]
 
         # TODO: adjust call_id to call_0, call_1, etc.
 
@@ -129,16 +158,16 @@ def load_and_transform_chat_threads(features):
 
     chat_threads_train_dataset = chat_threads_train_dataset.map(
         transform_chat_threads,
-        batched=False,
+        batched=True,
+        batch_size=map_batch_size,
         features=features,
         # remove_columns=chat_threads_dataset.column_names,
-        with_indices=True,
-        batch_size=4,
     )
 
-    assert chat_threads_train_dataset.column_names == list(
-        features.keys()
-    ), f"{chat_threads_train_dataset.column_names} != {list(features.keys())}"
+    if debug:
+        assert chat_threads_train_dataset.column_names == list(
+            features.keys()
+        ), f"{chat_threads_train_dataset.column_names} != {list(features.keys())}"
 
     return chat_threads_train_dataset
 
@@ -149,51 +178,58 @@ chat_threads_train_dataset = load_and_transform_chat_threads(features)
 def load_and_transform_chart_qa(features):
     chart_qa_train_dataset = load_dataset(
         "HuggingFaceM4/ChartQA", split="train", streaming=True
-    )
+    ).shuffle(buffer_size=shuffle_buffer_size, seed=42)
 
-    def transform_chart_qa(sample, indices):
+    def transform_chart_qa(batch):
         system_message = """You are a Vision Language Model specialized in interpreting visual data from chart images.
 Your task is to analyze the provided chart image and respond to queries with concise answers, usually a single word, number, or short phrase.
 The charts include a variety of types (e.g., line charts, bar charts) and contain colors, labels, and text.
 Focus on delivering accurate, succinct answers based on the visual information. Avoid additional explanation unless absolutely necessary."""
 
-        messages = [
-            {
-                "role": "system",
-                "content": [{"type": "text", "text": system_message}],
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                    },
-                    {
-                        "type": "text",
-                        "text": sample["query"],
-                    },
-                ],
-            },
-            {
-                "role": "assistant",
-                "content": [{"type": "text", "text": sample["label"][0]}],
-            },
-        ]
+        images_batch = []
+        messages_batch = []
 
-        return {"images": [sample["image"]], "messages": messages}
+        for image, query, label in zip(batch["image"], batch["query"], batch["label"]):
+            messages = [
+                {
+                    "role": "system",
+                    "content": [{"type": "text", "text": system_message}],
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image",
+                        },
+                        {
+                            "type": "text",
+                            "text": query,
+                        },
+                    ],
+                },
+                {
+                    "role": "assistant",
+                    "content": [{"type": "text", "text": label[0]}],
+                },
+            ]
+
+            images_batch.append([image])
+            messages_batch.append(messages)
+
+        return {"images": images_batch, "messages": messages_batch}
 
     chart_qa_train_dataset = chart_qa_train_dataset.map(
         transform_chart_qa,
-        batched=False,
+        batched=True,
+        batch_size=map_batch_size,
         features=features,
         remove_columns=chart_qa_train_dataset.column_names,
-        with_indices=True,
-        batch_size=4,
     )
 
-    assert chart_qa_train_dataset.column_names == list(
-        features.keys()
-    ), f"{chart_qa_train_dataset.column_names} != {list(features.keys())}"
+    if debug:
+        assert chart_qa_train_dataset.column_names == list(
+            features.keys()
+        ), f"{chart_qa_train_dataset.column_names} != {list(features.keys())}"
 
     return chart_qa_train_dataset
 
@@ -204,49 +240,57 @@ chart_qa_train_dataset = load_and_transform_chart_qa(features)
 def load_and_transform_latex_dataset(features):
     latex_ocr_train_dataset = load_dataset(
         "unsloth/LaTeX_OCR", split="train", streaming=True
-    )
+    ).shuffle(buffer_size=shuffle_buffer_size, seed=42)
 
     def transform_latex_ocr(
-        sample,
-        indices,
+        batch,
         image_key="image",
         text_key="text",
     ):
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Write the LaTeX representation for this image.",
-                    },
-                    {"type": "image"},
-                ],
-            },
-            {
-                "role": "assistant",
-                "content": [{"type": "text", "text": sample[text_key]}],
-            },
-        ]
+        completion_batch = []
+        images_batch = []
+        prompt_batch = []
+
+        for image, text in zip(batch[image_key], batch[text_key]):
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Write the LaTeX representation for this image.",
+                        },
+                        {"type": "image"},
+                    ],
+                },
+                {
+                    "role": "assistant",
+                    "content": [{"type": "text", "text": text}],
+                },
+            ]
+
+            completion_batch.append(messages[1:])
+            images_batch.append([image])
+            prompt_batch.append(messages[:1])
 
         return {
-            "completion": messages[1:],
-            "images": [sample[image_key]],
-            "prompt": messages[:1],
+            "completion": completion_batch,
+            "images": images_batch,
+            "prompt": prompt_batch,
         }
 
     latex_ocr_train_dataset = latex_ocr_train_dataset.map(
         transform_latex_ocr,
-        batched=False,
+        batched=True,
+        batch_size=map_batch_size,
         features=features,
         remove_columns=latex_ocr_train_dataset.column_names,
-        with_indices=True,
-        batch_size=4,
     )
 
-    assert latex_ocr_train_dataset.column_names == list(
-        features.keys()
-    ), f"{latex_ocr_train_dataset.column_names} != {list(features.keys())}"
+    if debug:
+        assert latex_ocr_train_dataset.column_names == list(
+            features.keys()
+        ), f"{latex_ocr_train_dataset.column_names} != {list(features.keys())}"
 
     return latex_ocr_train_dataset
 
@@ -256,14 +300,19 @@ latex_ocr_train_dataset = load_and_transform_latex_dataset(features)
 train_dataset = interleave_datasets(
     # [chat_threads_train_dataset, chart_qa_train_dataset, latex_ocr_train_dataset],
     [chat_threads_train_dataset, latex_ocr_train_dataset],
-    # probabilities=
+    probabilities=[0.5, 0.5],
     seed=42,
     stopping_strategy="first_exhausted",
 )
 
-assert train_dataset.column_names == list(
-    features.keys()
-), f"{train_dataset.column_names} != {list(features.keys())}"
+# datasets stops any DataLoader workers beyond the stream's shard count, and
+# interleave_datasets only has as many shards as its smallest input
+dataloader_num_workers = min(4, train_dataset.num_shards, os.cpu_count() or 1)
+
+if debug:
+    assert train_dataset.column_names == list(
+        features.keys()
+    ), f"{train_dataset.column_names} != {list(features.keys())}"
 
 model, processor = FastVisionModel.from_pretrained(
     "HuggingFaceTB/SmolVLM-Instruct",
@@ -386,7 +435,11 @@ chat_template = (
     f"{content_template}"
     "{%- if config.has_tools -%}"
     "{{ '\n\n' }}You are aware of the following tools in your environment:"
-    f"{tools_template}"
+    # Use the tools block pre-rendered by the caller when there is one
+    "{%- if tools_block is defined -%}"
+    "{{ tools_block }}"
+    "{%- else -%}"
+    "{{ '\n' }}" + tools_template.removeprefix("\n") + "{%- endif -%}"
     "{%- endif -%}"
     "{{ eos_token }}{{ '\n' }}"
     "{%- endif -%}"
@@ -442,6 +495,11 @@ prompt_before = processor.apply_chat_template(
 processor.chat_template = chat_template
 processor.tokenizer.chat_template = chat_template
 
+# Compile the chat template once so collate_fn renders with it directly
+compiled_chat_template = _compile_jinja_template(chat_template)
+compiled_tools_template = _compile_jinja_template(tools_template)
+special_tokens_map = processor.tokenizer.special_tokens_map
+
 # Show the same example of prompt generated from chat_template after setting it
 prompt = processor.apply_chat_template(
     add_generation_prompt=True,
@@ -462,8 +520,20 @@ assert (
     processor.chat_template == processor.tokenizer.chat_template
 ), f"{processor.chat_template} != {processor.tokenizer.chat_template}"
 
-with open("chat_template.txt", "w") as f:
-    f.write(processor.chat_template)
+# Only the first local process writes the template, and only when it changed
+if int(os.getenv("LOCAL_RANK", "0")) == 0:
+    chat_template_path = "chat_template.txt"
+
+    if not os.path.exists(chat_template_path):
+        existing_chat_template = None
+
+    else:
+        with open(chat_template_path) as f:
+            existing_chat_template = f.read()
+
+    if existing_chat_template != processor.chat_template:
+        with open(chat_template_path, "w") as f:
+            f.write(processor.chat_template)
 
 # model.save_pretrained_merged(
 #     "models/pretrained_merged_model",
@@ -503,6 +573,15 @@ image_token_id = processor.tokenizer.additional_special_tokens_ids[
     processor.tokenizer.additional_special_tokens.index("<image>")
 ]
 
+# Per-channel constants that fold the processor's rescale and normalize into a
+# single multiply-add: (x * rescale_factor - mean) / std == x * scale + bias.
+# They live on the model's device so the collator can ship uint8 pixel values.
+image_mean = torch.tensor(processor.image_processor.image_mean).view(-1, 1, 1)
+image_std = torch.tensor(processor.image_processor.image_std).view(-1, 1, 1)
+pixel_dtype = torch.bfloat16 if is_bfloat16_supported() else torch.float16
+pixel_scale = (processor.image_processor.rescale_factor / image_std).to(model.device)
+pixel_bias = (-image_mean / image_std).to(model.device)
+
 
 def collate_fn(examples):
     conversations = []
@@ -523,16 +602,10 @@ def collate_fn(examples):
             }
         )
 
-    text_batch = [
-        processor.apply_chat_template(
-            add_generation_prompt=False,
-            conversation=conversation["messages"],
-            documents=None,
-            tokenize=False,
-            tools=conversation["tools"],
-        )
-        for conversation in conversations
+    rendered_batch = [
+        render_conversation(conversation) for conversation in conversations
     ]
+    text_batch = [text for text, _ in rendered_batch]
 
     if verbose:
         for text in text_batch:
@@ -540,35 +613,27 @@ def collate_fn(examples):
             print(text)
 
     tokenized_text_batch = [
-        processor.apply_chat_template(
-            add_generation_prompt=False,
-            conversation=conversation["messages"],
-            documents=None,
-            return_assistant_tokens_mask=True,
-            return_dict=True,
-            return_tensors="pt",
-            tokenize=True,
-            tools=conversation["tools"],
-        )
-        for conversation in conversations
+        tokenize_rendered_conversation(text, generation_indices)
+        for text, generation_indices in rendered_batch
     ]
 
     images_batch = [conversation["images"] for conversation in conversations]
 
-    for images in images_batch:
-        if images is not None:
-            for image in images:
-                assert (
-                    type(image) == PIL.PngImagePlugin.PngImageFile
-                ), f"{type(image)} != PIL.PngImagePlugin.PngImageFile"
-                assert image.mode == "RGB", f"{image.mode} != RGB"
-
-                if verbose:
+    if verbose:
+        for images in images_batch:
+            if images is not None:
+                for image in images:
                     print("image.size:")
                     print(image.size)
 
+    # if all images are None in the batch, the processor can pad the text batch itself
+    if all(images is None for images in images_batch):
+        batch = processor(
+            text=text_batch, images=None, return_tensors="pt", padding=True
+        )
+
     # if any images are None in the batch, we need to process them separately
-    if any(images is None for images in images_batch):
+    elif any(images is None for images in images_batch):
         batch = {
             "attention_mask": [],
             "input_ids": [],
@@ -578,124 +643,194 @@ def collate_fn(examples):
 
         for text, images in zip(text_batch, images_batch):
             processed = processor(
-                text=text, images=images, return_tensors="pt", padding=True
+                text=text,
+                images=images,
+                return_tensors="pt",
+                do_normalize=False,
+                do_rescale=False,
             )
 
-            batch["attention_mask"].append(processed["attention_mask"])
-            batch["input_ids"].append(processed["input_ids"])
-
-            if "pixel_attention_mask" in processed:
-                batch["pixel_attention_mask"].append(processed["pixel_attention_mask"])
-
-            else:
-                batch["pixel_attention_mask"].append(torch.tensor([]))
+            batch["attention_mask"].append(processed["attention_mask"][0])
+            batch["input_ids"].append(processed["input_ids"][0])
 
             if "pixel_values" in processed:
+                batch["pixel_attention_mask"].append(processed["pixel_attention_mask"])
                 batch["pixel_values"].append(processed["pixel_values"])
 
-            else:
-                batch["pixel_values"].append(torch.tensor([]))
-
-        for key, value in batch.items():
-            batch[key] = torch.cat(value, dim=0)
+        # Examples are tokenized separately, so pad them to a common length here
+        batch["attention_mask"] = torch.nn.utils.rnn.pad_sequence(
+            batch["attention_mask"], batch_first=True, padding_value=0
+        )
+        batch["input_ids"] = torch.nn.utils.rnn.pad_sequence(
+            batch["input_ids"],
+            batch_first=True,
+            padding_value=processor.tokenizer.pad_token_id,
+        )
+        batch["pixel_attention_mask"] = stack_padded_images(
+            batch["pixel_attention_mask"]
+        )
+        batch["pixel_values"] = stack_padded_images(batch["pixel_values"])
 
     else:
         batch = processor(
-            text=text_batch, images=images_batch, return_tensors="pt", padding=True
+            text=text_batch,
+            images=images_batch,
+            return_tensors="pt",
+            padding=True,
+            do_normalize=False,
+            do_rescale=False,
         )
 
-    assistant_masks = []
+    # One mask for the whole batch, filled row by row
+    assistant_masks = torch.zeros_like(batch["input_ids"], dtype=torch.bool)
 
     for i in range(len(batch["input_ids"])):
-        assistant_mask = torch.zeros_like(batch["input_ids"][i])
-        offset = 0
-
-        for j in range(len(tokenized_text_batch[i]["input_ids"][0])):
-            if tokenized_text_batch[i]["input_ids"][0][j] == image_token_id:
-                while (
-                    batch["input_ids"][i][j + offset]
-                    != tokenized_text_batch[i]["input_ids"][0][j + 1]
-                ):
-                    offset += 1
-
-                offset -= 1
-
-            else:
-                assert (
-                    tokenized_text_batch[i]["input_ids"][0][j]
-                    == batch["input_ids"][i][j + offset]
-                ), f"{tokenized_text_batch[i]['input_ids'][0][j]} != {batch["input_ids"][i][j+offset]}"
-
-                if tokenized_text_batch[i]["assistant_masks"][j] == 1:
-                    assistant_mask[j + offset] = 1
-
-        decoded_assistant_input_ids = processor.tokenizer.decode(
-            batch["input_ids"][i][assistant_mask == 1]
-        )
-        decoded_assistant_tokenized_text_batch_input_ids = processor.tokenizer.decode(
-            tokenized_text_batch[i]["input_ids"][0][
-                torch.tensor(tokenized_text_batch[i]["assistant_masks"]) == 1
-            ]
+        align_assistant_mask(
+            tokenized_text_batch[i]["input_ids"][0],
+            tokenized_text_batch[i]["assistant_masks"],
+            batch["input_ids"][i],
+            assistant_masks[i],
         )
 
-        assert (
-            decoded_assistant_input_ids
-            == decoded_assistant_tokenized_text_batch_input_ids
-        ), f"{decoded_assistant_input_ids} != {decoded_assistant_tokenized_text_batch_input_ids}"
+        # Every assistant token should survive the alignment
+        assert int(assistant_masks[i].sum()) == int(
+            tokenized_text_batch[i]["assistant_masks"].sum()
+        ), f"{int(assistant_masks[i].sum())} != {int(tokenized_text_batch[i]['assistant_masks'].sum())}"
 
-        assistant_masks.append(assistant_mask)
+        if validate_collate:
+            decoded_assistant_input_ids = processor.tokenizer.decode(
+                batch["input_ids"][i][assistant_masks[i]]
+            )
+            decoded_assistant_tokenized_text_batch_input_ids = (
+                processor.tokenizer.decode(
+                    tokenized_text_batch[i]["input_ids"][0][
+                        tokenized_text_batch[i]["assistant_masks"] == 1
+                    ]
+                )
+            )
+
+            assert (
+                decoded_assistant_input_ids
+                == decoded_assistant_tokenized_text_batch_input_ids
+            ), f"{decoded_assistant_input_ids} != {decoded_assistant_tokenized_text_batch_input_ids}"
 
-    assistant_masks = torch.stack(assistant_masks)
-    labels = torch.where(assistant_masks == 1, batch["input_ids"], torch.tensor(-100))
+    labels = torch.where(assistant_masks, batch["input_ids"], -100)
 
     batch["labels"] = labels
 
-    if len(batch["pixel_attention_mask"]) == 0:
+    if "pixel_attention_mask" in batch and len(batch["pixel_attention_mask"]) == 0:
         del batch["pixel_attention_mask"]
 
-    if len(batch["pixel_values"]) == 0:
+    if "pixel_values" in batch and len(batch["pixel_values"]) == 0:
         del batch["pixel_values"]
 
     return batch
 
 
-def extract_messages(example, messages_key="messages"):
-    messages = []
+def stack_padded_images(tensors):
+    """
+    Stacks per-example image tensors whose image (tile) counts and sizes can
+    differ into a single tensor, allocated once and zero-padded the same way
+    the processor pads a batch.
+
+    Args:
+        tensors (List[torch.Tensor]): Tensors of shape (1, images, ...)
+
+    Returns:
+        torch.Tensor: The stacked tensor of shape (len(tensors), max_images, ...)
+    """
+    shape = [sum(len(tensor) for tensor in tensors)] + [
+        max(tensor.shape[dim] for tensor in tensors)
+        for dim in range(1, tensors[0].dim())
+    ]
+    stacked = tensors[0].new_zeros(shape)
+    offset = 0
 
-    if example[messages_key] is None:
-        return messages
+    for tensor in tensors:
+        stacked[
+            (slice(offset, offset + len(tensor)),)
+            + tuple(slice(0, size) for size in tensor.shape[1:])
+        ] = tensor
+        offset += len(tensor)
 
-    for role_idx in range(len(example[messages_key]["role"])):
-        message = {"role": example[messages_key]["role"][role_idx]}
+    return stacked
 
-        contents = example[messages_key]["content"][role_idx]
 
-        if type(contents) == str:
-            message["content"] = contents
+def align_assistant_mask(
+    tokenized_input_ids, tokenized_assistant_mask, input_ids, assistant_mask
+):
+    """
+    Maps an assistant mask over the template tokenization onto the processor's
+    input_ids, in which every <image> token has been expanded into a run of
+    image tokens.
 
-        elif type(contents) == list:
-            message["content"] = contents
+    Args:
+        assistant_mask (torch.Tensor): A zeroed boolean row aligned to
+            `input_ids`, filled in place
 
-        tool_calls = example[messages_key]["tool_calls"][role_idx]
+    Returns:
+        torch.Tensor: The filled `assistant_mask`
+    """
+    image_positions = (tokenized_input_ids == image_token_id).nonzero().flatten()
+    shifts = torch.zeros_like(tokenized_input_ids)
+    offset = 0
+
+    for position in image_positions.tolist():
+        # The expanded run ends right before the token that followed <image>
+        run_length = int(
+            (
+                input_ids[position + offset :] == tokenized_input_ids[position + 1]
+            ).nonzero()[0]
+        )
 
-        if tool_calls is not None:
-            message["tool_calls"] = []
+        shifts[position + 1] = run_length - 1
+        offset += run_length - 1
+
+    positions = torch.arange(len(tokenized_input_ids)) + shifts.cumsum(dim=0)
+    text_positions = tokenized_input_ids != image_token_id
 
-            for tool_call_idx in range(len(tool_calls["id"])):
+    assert torch.equal(
+        input_ids[positions[text_positions]], tokenized_input_ids[text_positions]
+    ), f"{input_ids[positions[text_positions]]} != {tokenized_input_ids[text_positions]}"
 
-                tool_call = {
+    assistant_mask[positions[text_positions]] = tokenized_assistant_mask[
+        text_positions
+    ].bool()
+
+    return assistant_mask
+
+
+def extract_messages(example, messages_key="messages"):
+    columns = example[messages_key]
+
+    if columns is None:
+        return []
+
+    messages = []
+
+    for role, contents, tool_calls in zip(
+        columns["role"], columns["content"], columns["tool_calls"]
+    ):
+        message = {"role": role}
+
+        if type(contents) in (str, list):
+            message["content"] = contents
+
+        if tool_calls is not None:
+            message["tool_calls"] = [
+                {
                     "function": {
-                        "arguments": tool_calls["function"][tool_call_idx]["arguments"],
-                        "description": tool_calls["function"][tool_call_idx][
-                            "description"
-                        ],
-                        "name": tool_calls["function"][tool_call_idx]["name"],
+                        "arguments": function["arguments"],
+                        "description": function["description"],
+                        "name": function["name"],
                     },
-                    "id": tool_calls["id"][tool_call_idx],
-                    "type": tool_calls["type"][tool_call_idx],
+                    "id": tool_call_id,
+                    "type": tool_call_type,
                 }
-
-                message["tool_calls"].append(tool_call)
+                for function, tool_call_id, tool_call_type in zip(
+                    tool_calls["function"], tool_calls["id"], tool_calls["type"]
+                )
+            ]
 
         messages.append(message)
 
@@ -703,31 +838,143 @@ def extract_messages(example, messages_key="messages"):
 
 
 def extract_tools(example):
-    tools = []
-
     if example["tools"] is None:
-        return tools
+        return []
 
-    for function_idx in range(len(example["tools"]["function"])):
-        tool = {
+    return [
+        {
             "function": {
-                "description": example["tools"]["function"][function_idx][
-                    "description"
-                ],
-                "name": example["tools"]["function"][function_idx]["name"],
-                "parameters": example["tools"]["function"][function_idx]["parameters"],
+                "description": function["description"],
+                "name": function["name"],
+                "parameters": function["parameters"],
             },
-            "type": example["tools"]["type"][function_idx],
+            "type": tool_type,
         }
+        for function, tool_type in zip(
+            example["tools"]["function"], example["tools"]["type"]
+        )
+    ]
+
 
-        tools.append(tool)
+def render_conversation(conversation):
+    """
+    Renders a conversation with the chat template in a single pass, tracking
+    where the assistant generations land in the rendered text.
 
-    return tools
+    Returns:
+        Tuple[str, List[Tuple[int, int]]]: The rendered text and the character
+            spans of each {% generation %} block within it
+    """
+    template_kwargs = {}
+
+    if conversation["tools"]:
+        template_kwargs["tools_block"] = render_tools_block(
+            json.dumps(conversation["tools"])
+        )
+
+    return _render_with_assistant_indices(
+        compiled_template=compiled_chat_template,
+        messages=conversation["messages"],
+        tools=conversation["tools"],
+        documents=None,
+        add_generation_prompt=False,
+        **special_tokens_map,
+        **template_kwargs,
+    )
 
 
+@functools.lru_cache(maxsize=1024)
+def render_tools_block(tools_json):
+    """
+    Renders the tools section of the system message once per distinct set of
+    tools, since most conversations reuse the same tool definitions.
+
+    Args:
+        tools_json (str): The tools serialized as JSON, used as the cache key
+
+    Returns:
+        str: The rendered tools block, without the trailing whitespace that the
+            chat template strips after it
+    """
+    return compiled_tools_template.render(tools=json.loads(tools_json)).rstrip()
+
+
+def tokenize_rendered_conversation(text, generation_indices):
+    """
+    Tokenizes an already rendered conversation and marks the tokens that
+    overlap an assistant generation span.
+
+    Returns:
+        transformers.BatchEncoding: The tokenized text with an `assistant_masks`
+            tensor aligned to `input_ids[0]`
+    """
+    tokenized = processor.tokenizer(
+        text,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        return_tensors="pt",
+    )
+
+    token_starts, token_ends = tokenized.pop("offset_mapping")[0].unbind(-1)
+    assistant_mask = torch.zeros_like(token_starts, dtype=torch.bool)
+
+    for start, end in generation_indices:
+        assistant_mask |= (token_ends > start) & (token_starts < end)
+
+    tokenized["assistant_masks"] = assistant_mask.long()
+
+    return tokenized
+
+
+def normalize_pixel_values(pixel_values, pixel_attention_mask=None):
+    """
+    Rescales and normalizes raw uint8 pixel values in one fused multiply-add
+    instead of the processor's separate rescale and normalize passes. The
+    arithmetic runs in float32 and is cast to pixel_dtype once at the end, so
+    the result is rounded only once.
+
+    Args:
+        pixel_values (torch.Tensor): Unnormalized uint8 pixel values of shape
+            (batch, images, channels, height, width)
+        pixel_attention_mask (torch.Tensor, optional): Mask of shape
+            (batch, images, height, width) marking the real (unpadded) pixels
+
+    Returns:
+        torch.Tensor: The normalized pixel values in pixel_dtype, with padding
+            left at zero (when a mask is given) so the model still recognizes
+            padded images
+    """
+    pixel_values = pixel_values.float().mul_(pixel_scale).add_(pixel_bias)
+
+    if pixel_attention_mask is not None:
+        pixel_values.masked_fill_(~pixel_attention_mask.bool().unsqueeze(-3), 0.0)
+
+    return pixel_values.to(pixel_dtype)
+
+
+def normalize_pixel_values_hook(module, args, kwargs):
+    """
+    Forward pre-hook that normalizes the uint8 pixel values from collate_fn
+    once they have been copied to the model's device.
+    """
+    if kwargs.get("pixel_values") is not None:
+        kwargs["pixel_values"] = normalize_pixel_values(
+            kwargs["pixel_values"], kwargs.get("pixel_attention_mask")
+        )
+
+    return args, kwargs
+
+
+model.register_forward_pre_hook(normalize_pixel_values_hook, with_kwargs=True)
+
 trainer = SFTTrainer(
     args=SFTConfig(
         bf16=is_bfloat16_supported(),
+        # Build batches in worker processes so collate_fn overlaps with the GPU
+        dataloader_num_workers=dataloader_num_workers,
+        dataloader_persistent_workers=True,
+        dataloader_pin_memory=True,
+        dataloader_prefetch_factor=4,
         fp16=not is_bfloat16_supported(),
         gradient_accumulation_steps=4,
         logging_steps=1,
@@ -738,9 +985,8 @@ trainer = SFTTrainer(
         # max_steps=30,
         max_steps=3,
         # num_train_epochs = 1, # Set this instead of max_steps for full training runs
-        optim="adamw_8bit",
+        optim=optim,
         # optim = "paged_adamw_8bit",
-        # optim="adamw_torch_fused",
         output_dir=args.output_dir,
         # per_device_train_batch_size=2,
         per_device_train_batch_size=1,
@@ -782,8 +1028,16 @@ except torch._dynamo.exc.BackendCompilerFailed as e:
 
     trainer_stats = trainer.train()
 
-run_id = mlflow.last_active_run().info.run_id
-print(f"run_id: {run_id}")
+if torch.cuda.is_available():
+    print(f"peak memory: {torch.cuda.max_memory_allocated() / 1024**3:.2f} GiB")
+
+# Only the main process has an MLflow run to log the adapter to
+if trainer.is_world_process_zero():
+    run_id = mlflow.last_active_run().info.run_id
+    print(f"run_id: {run_id}")
+
+    model.save_pretrained("lora_model")
+    processor.save_pretrained("lora_model")
 
-model.save_pretrained("lora_model")
-processor.save_pretrained("lora_model")
+    with mlflow.start_run(run_id=run_id):
+        mlflow.log_artifacts("lora_model", artifact_path="lora_model")
@@ -17,6 +17,7 @@ from timestep.config import settings
 app_dir = settings.app_dir
 connexion_app = AsyncApp(import_name=__name__)
 default_hf_repo_id = settings.default_hf_repo_id
+package_dir = os.path.dirname(os.path.abspath(__file__))
 
 client = AsyncOpenAI(
     api_key="sk-no-key-required",
@@ -55,6 +56,8 @@ fastapi_app.mount("/api", ConnexionMiddleware(app=connexion_app, import_name=__n
 
 
 class Message:
+    __slots__ = ("message_type", "text", "user_name")
+
     def __init__(self, user_name: str, text: str, message_type: str):
         self.user_name = user_name
         self.text = text
@@ -62,6 +65,22 @@ class Message:
 
 
 class ChatMessage(ft.Row):
+    colors_lookup = (
+        ft.colors.AMBER,
+        ft.colors.BLUE,
+        ft.colors.BROWN,
+        ft.colors.CYAN,
+        ft.colors.GREEN,
+        ft.colors.INDIGO,
+        ft.colors.LIME,
+        ft.colors.ORANGE,
+        ft.colors.PINK,
+        ft.colors.PURPLE,
+        ft.colors.RED,
+        ft.colors.TEAL,
+        ft.colors.YELLOW,
+    )
+
     def __init__(self, message: Message):
         super().__init__()
 
@@ -96,23 +115,7 @@ class ChatMessage(ft.Row):
             return "Unknown"  # or any default value you prefer
 
     def get_avatar_color(self, user_name: str):
-        colors_lookup = [
-            ft.colors.AMBER,
-            ft.colors.BLUE,
-            ft.colors.BROWN,
-            ft.colors.CYAN,
-            ft.colors.GREEN,
-            ft.colors.INDIGO,
-            ft.colors.LIME,
-            ft.colors.ORANGE,
-            ft.colors.PINK,
-            ft.colors.PURPLE,
-            ft.colors.RED,
-            ft.colors.TEAL,
-            ft.colors.YELLOW,
-        ]
-
-        return colors_lookup[hash(user_name) % len(colors_lookup)]
+        return self.colors_lookup[hash(user_name) % len(self.colors_lookup)]
 
     def to_dict(self):
         if self.user_name_view.value == "Assistant":
@@ -315,18 +318,22 @@ class Engine(str, Enum):
     copilot_codex = "copilot-codex"
 
 
+# The engine list is static, so build the response once
+engines = {
+    "data": [
+        {
+            "id": Engine.copilot_codex,
+            "name": "Copilot Codex",
+            "description": "OpenAI's Codex model, formerly known as GitHub Copilot",
+        }
+    ]
+}
+
+
 @fastapi_app.get("/v1/engines")
 async def list_engines():
     # return [engine.value for engine in Engine]
-    return {
-        "data": [
-            {
-                "id": Engine.copilot_codex,
-                "name": "Copilot Codex",
-                "description": "OpenAI's Codex model, formerly known as GitHub Copilot",
-            }
-        ]
-    }
+    return engines
 
 
 @fastapi_app.post("/v1/engines/{engine}/completions")
@@ -362,25 +369,23 @@ def main(*args, **kwargs):
     print(f"args: {args}")
     print(f"kwargs: {kwargs}")
 
-    cwd = os.getcwd()
-    print(f"cwd: {cwd}")
-
     uvicorn.run(
         f"{__name__}:fastapi_app",
         # host="0.0.0.0",
         host=kwargs.get("host", "0.0.0.0"),
+        # Use httptools and uvloop when they are installed (not on Windows)
+        http="auto",
         log_level="info",
-        loop="asyncio",
+        # loop="asyncio",
+        loop="auto",
         # port=8000,
         # port=kwargs.get("port", 8000),
         port=kwargs.get("port", 8080),
         # reload=True,
         reload=kwargs.get("dev", False),
-        reload_dirs=[
-            # f"{os.getcwd()}/timestep",
-            f"{os.getcwd()}/src/timestep",
-        ],
-        workers=1,
+        reload_dirs=[package_dir],
+        # flet's pubsub lives in-process, so chat only works across one worker
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
     )
 
 